@@ -8,24 +8,27 @@ Outputs: 16kHz, 8-bit unsigned mono WAV (~16KB per second)
 Usage:
     python voice_generator.py                    # Generate all phrases
     python voice_generator.py "Hello world"     # Generate single phrase
+    python voice_generator.py --no-cache        # Regenerate and re-cache TTS audio
 """
 
+import io
 import os
+import hashlib
 import sys
+import struct
 import asyncio
-import warnings
+from fractions import Fraction
 from pathlib import Path
 from typing import Optional
 import numpy as np
 
-# Suppress librosa warnings about short audio chunks
-warnings.filterwarnings("ignore", message="n_fft=.*is too large")
-
 try:
+    import aiohttp
     import edge_tts
     import librosa
+    from numba import njit
     import soundfile as sf
-    from scipy.io import wavfile
+    from scipy.signal import firwin, resample_poly
 except ImportError as e:
     print(f"Missing dependency: {e}")
     print("Install with: pip install edge-tts librosa soundfile scipy numpy")
@@ -34,9 +37,12 @@ except ImportError as e:
 
 # === CONFIGURATION ===
 OUTPUT_DIR = Path("./droid_sounds")
+CACHE_DIR = Path("./temp_audio/cache")  # Raw TTS audio, reused across runs
 SAMPLE_RATE = 16000      # 16kHz output
 PITCH_SHIFT_STEPS = 8    # Shift pitch up for robot sound (6-8 is Cozmo-like)
 SPEED_RATE = 1.12        # Slightly faster for energy
+MAX_CONCURRENT_CLIPS = 8 # Clips in flight at once (keeps Edge TTS from throttling)
+DITHER = False           # Add +/-0.5 LSB noise before rounding to 8-bit
 
 # Edge TTS voice - try these for different feels:
 # "en-US-GuyNeural" - male, friendly
@@ -138,84 +144,208 @@ PHRASES = {
 }
 
 
+# === DSP HELPERS ===
+@njit(nogil=True, fastmath=True, cache=True)
+def _phase_vocoder_kernel(mag, phase, time_steps, hop_length):
+    n_bins = mag.shape[0]
+    out = np.empty((n_bins, len(time_steps)), dtype=np.complex64)
+    
+    # Each bin accumulates its own phase, so bins are independent
+    for k in range(n_bins):
+        phi_advance = hop_length * np.pi * k / (n_bins - 1)
+        phase_acc = float(phase[k, 0])
+        for t in range(len(time_steps)):
+            i = int(time_steps[t])
+            alpha = time_steps[t] - i
+            m = (1 - alpha) * mag[k, i] + alpha * mag[k, i + 1]
+            out[k, t] = complex(m * np.cos(phase_acc), m * np.sin(phase_acc))
+            
+            # Phase advance relative to the bin's expected advance, wrapped to -pi..pi
+            dphase = phase[k, i + 1] - phase[k, i] - phi_advance
+            dphase -= 2 * np.pi * np.round(dphase / (2 * np.pi))
+            phase_acc += phi_advance + dphase
+    
+    return out
+
+
+def _phase_vocoder(D: np.ndarray, time_steps: np.ndarray, hop_length: int) -> np.ndarray:
+    """Phase vocoder that reads STFT frames at arbitrary (fractional) positions
+    
+    Same algorithm as librosa.phase_vocoder, but takes the frame positions
+    directly so the stretch rate can change over time. The inner loop is
+    compiled with numba (cached on disk) and releases the GIL, so clips
+    processed in worker threads run it in parallel.
+    """
+    # Pad 2 silent frames so reading frame i+1 never runs off the end
+    D = np.pad(D, [(0, 0), (0, 2)])
+    return _phase_vocoder_kernel(np.abs(D), np.angle(D),
+                                 np.asarray(time_steps, dtype=np.float64), hop_length)
+
+
+def _ramp_positions(n: int, end_ratio: float) -> np.ndarray:
+    """Running position when stepping by a ratio ramping from 1 to end_ratio
+    
+    A linear bend in semitones is a geometric ramp in ratio, so the running
+    sum of the steps has the closed form (r**k - 1) / (r - 1).
+    """
+    r = end_ratio ** (1 / (n - 1))
+    if r == 1:
+        return np.arange(n, dtype=np.float64)
+    return (r ** np.arange(n) - 1) / (r - 1)
+
+
+# === WAV OUTPUT ===
+# float32 so scaling float32 audio never promotes the buffer to float64
+_QUANT_SCALE = np.float32(127.5)
+
+# The format never changes (8-bit unsigned mono PCM at SAMPLE_RATE), so the
+# fmt chunk of the canonical 44-byte header is built once; only the RIFF
+# and data sizes differ per file.
+_WAV_FMT_CHUNK = struct.pack("<4sIHHIIHH", b"fmt ", 16, 1, 1,
+                             SAMPLE_RATE, SAMPLE_RATE, 1, 8)
+
+
+class _SharedConnector(aiohttp.TCPConnector):
+    """TCP connector shared by every Edge TTS request in a run
+    
+    edge_tts opens a new ClientSession per request and that session closes
+    the connector it was given, so close() is a no-op here and shutdown()
+    does the real teardown once all clips are done.
+    """
+    
+    async def close(self, **kwargs):
+        pass
+    
+    async def shutdown(self):
+        await super().close()
+
+
 class DroidVoiceGenerator:
     """Generates optimized robot voice clips for ESP32"""
     
-    def __init__(self):
-        self._temp_dir = Path("./temp_audio")
-        self._temp_dir.mkdir(exist_ok=True)
+    def __init__(self, use_cache: bool = True):
+        # Without the cache every phrase is re-synthesized, but the fresh
+        # audio still replaces the cached copy
+        self._use_cache = use_cache
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self._clip_slots = asyncio.Semaphore(MAX_CONCURRENT_CLIPS)
+        self._connector = None
+        # Pitch ratio as a small fraction so the polyphase filter stays short
+        self._pitch_ratio = Fraction(2 ** (PITCH_SHIFT_STEPS / 12)).limit_denominator(100)
+        self._resample_filters = {}
         print(f"Using voice: {VOICE}")
         print(f"Pitch shift: +{PITCH_SHIFT_STEPS} semitones")
         if ADD_END_INFLECTION:
             print(f"End inflection: +{INFLECTION_AMOUNT} semitones")
     
-    async def _generate_raw_tts(self, text: str, output_path: Path) -> bool:
-        """Generate TTS using Edge TTS"""
+    async def _generate_raw_tts(self, text: str) -> Optional[bytes]:
+        """Generate TTS using Edge TTS, returning the MP3 data"""
         try:
-            communicate = edge_tts.Communicate(text, VOICE)
-            await communicate.save(str(output_path))
-            return True
+            communicate = edge_tts.Communicate(text, VOICE, connector=self._connector)
+            buf = io.BytesIO()
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    buf.write(chunk["data"])
         except Exception as e:
             print(f"TTS failed: {e}")
-            return False
+            return None
+        return buf.getvalue()
+    
+    def _cache_path(self, text: str) -> Path:
+        """Cache file for a phrase; same voice and text always give the same audio"""
+        key = hashlib.sha1(f"{VOICE}|{text}".encode()).hexdigest()
+        return CACHE_DIR / f"{key}.mp3"
+    
+    def _write_cache(self, cache_path: Path, mp3_data: bytes):
+        """Store TTS audio in the cache; failures only cost a re-fetch next run"""
+        # Write then rename, so an interrupted run never leaves a truncated
+        # file that later runs would keep reading
+        temp_path = cache_path.with_suffix(".tmp")
+        try:
+            temp_path.write_bytes(mp3_data)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"Cache write failed: {e}")
+            temp_path.unlink(missing_ok=True)
+    
+    def _resample(self, y: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+        """Polyphase resample, reusing one FIR filter per rate pair"""
+        gcd = np.gcd(orig_sr, target_sr)
+        up, down = target_sr // gcd, orig_sr // gcd
+        if up == down:
+            return y
+        h = self._resample_filters.get((up, down))
+        if h is None:
+            # Same low-pass filter resample_poly would otherwise design on every call
+            max_rate = max(up, down)
+            h = firwin(20 * max_rate + 1, 1 / max_rate, window=("kaiser", 5.0))
+            h = h.astype(y.dtype)
+            self._resample_filters[(up, down)] = h
+        return resample_poly(y, up, down, window=h)
     
-    def _add_inflection(self, y: np.ndarray, sr: int) -> np.ndarray:
+    def _add_inflection(self, y: np.ndarray) -> np.ndarray:
         """Add upward pitch bend at the end of the audio"""
         if not ADD_END_INFLECTION:
             return y
         
         # Calculate where inflection starts
+        n_fft, hop = 256, 64
         inflection_samples = int(len(y) * INFLECTION_DURATION)
-        if inflection_samples < 100:
+        if inflection_samples < n_fft:
             return y
         
         # Split audio
         main_part = y[:-inflection_samples]
         end_part = y[-inflection_samples:]
         
-        # Create pitch bend envelope (0 to INFLECTION_AMOUNT)
-        bend_envelope = np.linspace(0, INFLECTION_AMOUNT, len(end_part))
+        # The pitch ratio ramps from 1 up to INFLECTION_AMOUNT semitones
+        D = librosa.stft(end_part, n_fft=n_fft, hop_length=hop)
+        end_ratio = 2 ** (INFLECTION_AMOUNT / 12)
         
-        # Apply gradual pitch shift to end part
-        # We'll do this by processing small chunks with increasing pitch
-        chunk_size = len(end_part) // 10
-        processed_end = []
+        # Read the stretched audio back at the same varying ratio, which
+        # restores the original length and bends the pitch up smoothly
+        read_pos = _ramp_positions(len(end_part), end_ratio)
+        stretched_len = int(np.ceil(read_pos[-1])) + 1
         
-        for i in range(10):
-            start = i * chunk_size
-            end = start + chunk_size if i < 9 else len(end_part)
-            chunk = end_part[start:end]
-            
-            # Average pitch shift for this chunk
-            avg_shift = bend_envelope[start:end].mean()
-            
-            if len(chunk) > 100:
-                shifted = librosa.effects.pitch_shift(chunk, sr=sr, n_steps=avg_shift)
-                processed_end.append(shifted)
-            else:
-                processed_end.append(chunk)
+        # Stretch each input frame by its ratio: output frame k reads the
+        # input at the position where the stretched timeline reaches k.
+        # Enough frames are made to cover every read position; any past the
+        # last input frame just hold it.
+        stretched_pos = _ramp_positions(D.shape[-1], end_ratio)
+        n_frames = -(-stretched_len // hop) + 1
+        time_steps = np.interp(np.arange(n_frames), stretched_pos, np.arange(D.shape[-1]))
+        stretched = librosa.istft(_phase_vocoder(D, time_steps, hop), hop_length=hop,
+                                  length=stretched_len)
         
-        end_processed = np.concatenate(processed_end)
+        end_processed = np.interp(read_pos, np.arange(len(stretched)), stretched)
+        
+        # np.interp always returns float64; keep the clip float32 so the
+        # normalize and quantize passes move half the bytes
+        end_processed = end_processed.astype(np.float32)
         
         return np.concatenate([main_part, end_processed])
     
-    def _apply_robot_effects(self, input_path: str) -> Optional[np.ndarray]:
+    def _apply_robot_effects(self, mp3_data: bytes) -> Optional[np.ndarray]:
         """Apply pitch shift and effects"""
         try:
-            # Load audio
-            y, sr = librosa.load(input_path, sr=None)
-            
-            # Speed up slightly for more energy
-            y = librosa.effects.time_stretch(y, rate=SPEED_RATE)
+            # Decode and bring straight down to the output rate so all the
+            # DSP below runs on the smaller buffer
+            y, sr = sf.read(io.BytesIO(mp3_data), dtype="float32")
+            if y.ndim == 2:
+                y = y.mean(axis=1)
+            y = self._resample(y, sr, SAMPLE_RATE)
             
-            # Main pitch shift for robot sound
-            y = librosa.effects.pitch_shift(y, sr=sr, n_steps=PITCH_SHIFT_STEPS)
+            # Speed up and pitch shift in a single phase-vocoder pass.
+            # Stretching by pitch/speed and then resampling down by the pitch
+            # ratio leaves the sped-up duration with the pitch raised.
+            pitch = self._pitch_ratio
+            D = librosa.stft(y, n_fft=512, hop_length=128)
+            time_steps = np.arange(0, D.shape[-1], SPEED_RATE / pitch)
+            y = librosa.istft(_phase_vocoder(D, time_steps, 128), hop_length=128)
+            y = self._resample(y, pitch.numerator, pitch.denominator)
             
             # Add end inflection
-            y = self._add_inflection(y, sr)
-            
-            # Resample to target rate
-            y = librosa.resample(y, orig_sr=sr, target_sr=SAMPLE_RATE)
+            y = self._add_inflection(y)
             
             # Normalize
             y = librosa.util.normalize(y)
@@ -227,43 +357,64 @@ class DroidVoiceGenerator:
     
     def _save_optimized(self, audio: np.ndarray, output_path: Path):
         """Save as 8-bit unsigned WAV for ESP32"""
-        audio_clipped = np.clip(audio, -1, 1)
-        audio_uint8 = ((audio_clipped + 1) * 127.5).astype(np.uint8)
-        wavfile.write(str(output_path), SAMPLE_RATE, audio_uint8)
+        # Scale and round in one buffer; rounding (rather than the truncating
+        # cast) avoids a -0.5 LSB bias. The audio is already normalized to
+        # [-1, 1], so only dither can push it outside 0..255.
+        scaled = audio * _QUANT_SCALE
+        scaled += _QUANT_SCALE
+        if DITHER:
+            scaled += np.random.uniform(-0.5, 0.5, size=scaled.shape)
+        np.rint(scaled, out=scaled)
+        if DITHER:
+            np.clip(scaled, 0, 255, out=scaled)
+        data = scaled.astype(np.uint8).tobytes()
         
-        size_kb = output_path.stat().st_size / 1024
+        wav = (struct.pack("<4sI4s", b"RIFF", 36 + len(data), b"WAVE") + _WAV_FMT_CHUNK
+               + struct.pack("<4sI", b"data", len(data)) + data)
+        output_path.write_bytes(wav)
+        
+        size_kb = len(wav) / 1024
         duration = len(audio) / SAMPLE_RATE
         print(f"    -> {output_path.name} ({size_kb:.1f}KB, {duration:.1f}s)")
     
     async def generate_clip(self, text: str, output_path: Path) -> bool:
         """Generate a single voice clip"""
-        temp_path = self._temp_dir / "temp_tts.mp3"
-        
-        # Step 1: Generate TTS
-        if not await self._generate_raw_tts(text, temp_path):
-            return False
-        
-        # Step 2: Apply effects
-        audio = self._apply_robot_effects(str(temp_path))
-        if audio is None:
-            return False
-        
-        # Step 3: Save optimized
-        self._save_optimized(audio, output_path)
-        
-        # Cleanup temp
-        if temp_path.exists():
-            temp_path.unlink()
-        
-        return True
+        async with self._clip_slots:
+            # Step 1: Generate TTS, or reuse the cached audio
+            cache_path = self._cache_path(text)
+            from_cache = self._use_cache and cache_path.exists()
+            if from_cache:
+                mp3_data = cache_path.read_bytes()
+            else:
+                mp3_data = await self._generate_raw_tts(text)
+                if mp3_data is None:
+                    return False
+            
+            # Step 2: Apply effects (in a thread so other clips' TTS keeps going)
+            audio = await asyncio.to_thread(self._apply_robot_effects, mp3_data)
+            if audio is None:
+                if from_cache:
+                    # Drop the bad entry so the next run fetches it again
+                    try:
+                        cache_path.unlink(missing_ok=True)
+                    except OSError as e:
+                        print(f"Cache cleanup failed: {e}")
+                return False
+            
+            # Only audio that made it through the effects gets cached
+            if not from_cache:
+                self._write_cache(cache_path, mp3_data)
+            
+            # Step 3: Save optimized
+            self._save_optimized(audio, output_path)
+            
+            return True
     
     async def generate_all_phrases(self):
         """Generate all phrases from the library"""
         OUTPUT_DIR.mkdir(exist_ok=True)
         
-        total_size = 0
-        total_clips = 0
-        
+        jobs = []
         for category, phrases in PHRASES.items():
             print(f"\n=== {category.upper()} ===")
             category_dir = OUTPUT_DIR / category
@@ -274,9 +425,21 @@ class DroidVoiceGenerator:
                 output_path = category_dir / filename
                 
                 print(f"  [{i+1:02d}] \"{phrase}\"")
-                if await self.generate_clip(phrase, output_path):
-                    total_size += output_path.stat().st_size
-                    total_clips += 1
+                jobs.append((category, i, phrase, output_path))
+        
+        print(f"\nGenerating {len(jobs)} clips...")
+        self._connector = _SharedConnector(ttl_dns_cache=None)
+        try:
+            results = await asyncio.gather(
+                *(self.generate_clip(phrase, output_path) for _, _, phrase, output_path in jobs)
+            )
+        finally:
+            await self._connector.shutdown()
+            self._connector = None
+        
+        generated = [output_path for (_, _, _, output_path), ok in zip(jobs, results) if ok]
+        total_size = sum(path.stat().st_size for path in generated)
+        total_clips = len(generated)
         
         print(f"\n{'='*40}")
         print(f"Generated {total_clips} clips")
@@ -284,23 +447,17 @@ class DroidVoiceGenerator:
         print(f"Output directory: {OUTPUT_DIR.absolute()}")
         print(f"\nCopy contents to your Arduino sketch's 'data' folder")
         print(f"Then upload using 'ESP32 LittleFS Data Upload'")
-    
-    def cleanup(self):
-        """Remove temp files"""
-        for f in self._temp_dir.glob("*"):
-            f.unlink()
-        try:
-            self._temp_dir.rmdir()
-        except:
-            pass
 
 
 async def main():
-    generator = DroidVoiceGenerator()
+    args = sys.argv[1:]
+    use_cache = "--no-cache" not in args
+    args = [arg for arg in args if arg != "--no-cache"]
+    generator = DroidVoiceGenerator(use_cache=use_cache)
     
-    if len(sys.argv) > 1:
+    if args:
         # Generate single phrase from command line
-        text = " ".join(sys.argv[1:])
+        text = " ".join(args)
         OUTPUT_DIR.mkdir(exist_ok=True)
         safe_name = "".join(c if c.isalnum() else "_" for c in text[:30])
         output_path = OUTPUT_DIR / f"custom_{safe_name}.wav"
@@ -312,8 +469,6 @@ async def main():
         print(f"Output: {SAMPLE_RATE}Hz, 8-bit mono (~16KB/sec)")
         print("="*40)
         await generator.generate_all_phrases()
-    
-    generator.cleanup()
 
 
 if __name__ == "__main__":